@@ -5,13 +5,64 @@ Script to perform signal extraction as a function of pT for several BDT output s
 import os
 import sys
 import argparse
+import functools
+import gc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+# must be set before TensorFlow is imported (also by flarefly)
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
 import numpy as np
+import matplotlib.pyplot as plt
+from numba import njit, prange
+import tensorflow as tf
 from flarefly.data_handler import DataHandler
 from flarefly.fitter import F2MassFitter
 import yaml
 import pdg
 import ROOT
 
+NOCUT_HISTO_TITLES = {
+    "rawyield": "raw yield",
+    "sigma": "#sigma (GeV/#it{c}^{2})",
+    "mean": "#mu (GeV/#it{c}^{2})",
+    "alphal": "#alpha_{l}",
+    "alphar": "#alpha_{r}",
+    "nl": "#it{n}_{l}",
+    "nr": "#it{n}_{r}"
+}
+
+# initial values and limits (None if not limited) of the fit parameters
+INIT_PARS = {
+    "dstar": {
+        "signal": {
+            "sigma": (0.0005, [0.0001, 0.002]),
+            "frac": (0.1, None),
+            "alphal": (1.5, [1., 3.]),
+            "alphar": (1.5, [1., 3.]),
+            "nl": (50, [30., 100.]),
+            "nr": (50, [30., 100.])
+        },
+        "background": {
+            "power": (0.5, None),
+            "c1": (-20, None),
+            "c2": (500, None),
+            "c3": (-5000, None)
+        }
+    },
+    "dplus": {
+        "signal": {
+            "sigma": (0.005, [0.0001, 0.04]),
+            "frac": (0.1, None)
+        },
+        "background": {
+            "c0": (0.4, None),
+            "c1": (-0.2, None),
+            "c2": (-0.01, None),
+            "c3": (0.01, None)
+        }
+    }
+}
+
 def check_config_consistency(cfg):
     pt_mins = cfg["pt_mins"]
     pt_maxs = cfg["pt_maxs"]
@@ -34,36 +85,37 @@ def check_config_consistency(cfg):
         sys.exit()
 
 
-def perform_fit(file_name, histo_name, fitter_name, sgn_func, bkg_func, mass_min, mass_max, init_mass, part_name, signal_pars_tofix={}):
+@functools.lru_cache(maxsize=None)
+def get_input_file(file_name):
+    """
+    Helper method to open an input ROOT file only once per process
+    """
+    return ROOT.TFile.Open(file_name)
+
+
+def perform_fit(hist, fitter_name, sgn_func, bkg_func, mass_min, mass_max, init_mass, part_name, signal_pars_tofix={}):
     """
 
     """
-    data_hdl = DataHandler(file_name, varname = r"Inv Mass (GeV/c^2)", histoname=histo_name, limits=[mass_min, mass_max])
+    data_hdl = DataHandler(hist, varname = r"Inv Mass (GeV/c^2)", limits=[mass_min, mass_max])
+    # a new fitter is needed for each fit: F2MassFitter cannot swap its data handler and it
+    # rebuilds the zfit pdfs at each mass_zfit call, so reusing it would not save any tracing
     fitter = F2MassFitter(data_hdl,
                               name_signal_pdf=[sgn_func],
                               name_background_pdf=[bkg_func],
                               name=fitter_name, tol=0.1)
-    if part_name == "dstar":
-        fitter.set_particle_mass(0, mass=init_mass, limits=[init_mass * 0.95, init_mass * 1.05])
-        fitter.set_signal_initpar(0, "sigma", 0.0005, limits=[0.0001, 0.002])
-        fitter.set_signal_initpar(0, "frac", 0.1)
-        fitter.set_signal_initpar(0, "alphal", 1.5, limits=[1., 3.])
-        fitter.set_signal_initpar(0, "alphar", 1.5, limits=[1., 3.])
-        fitter.set_signal_initpar(0, "nl", 50, limits=[30., 100.])
-        fitter.set_signal_initpar(0, "nr", 50, limits=[30., 100.])
-        fitter.set_background_initpar(0, "power", 0.5)
-        fitter.set_background_initpar(0, "c1", -20)
-        fitter.set_background_initpar(0, "c2", 500)
-        fitter.set_background_initpar(0, "c3", -5000)
-    if part_name == "dplus":
-        fitter.set_particle_mass(0, mass=init_mass, limits=[init_mass * 0.95, init_mass * 1.05])
-        fitter.set_signal_initpar(0, "sigma", 0.005, limits=[0.0001, 0.04])
-        fitter.set_signal_initpar(0, "frac", 0.1)
-        fitter.set_background_initpar(0, "c0", 0.4)
-        fitter.set_background_initpar(0, "c1", -0.2)
-        fitter.set_background_initpar(0, "c2", -0.01)
-        fitter.set_background_initpar(0, "c3", 0.01)
-        
+    fitter.set_particle_mass(0, mass=init_mass, limits=[init_mass * 0.95, init_mass * 1.05])
+    for par, (init_value, limits) in INIT_PARS[part_name]["signal"].items():
+        if limits is None:
+            fitter.set_signal_initpar(0, par, init_value)
+        else:
+            fitter.set_signal_initpar(0, par, init_value, limits=limits)
+    for par, (init_value, limits) in INIT_PARS[part_name]["background"].items():
+        if limits is None:
+            fitter.set_background_initpar(0, par, init_value)
+        else:
+            fitter.set_background_initpar(0, par, init_value, limits=limits)
+
     if len(signal_pars_tofix) > 0:
         for par in signal_pars_tofix:
             fitter.set_signal_initpar(0, par, signal_pars_tofix[par], fix=True)
@@ -72,8 +124,138 @@ def perform_fit(file_name, histo_name, fitter_name, sgn_func, bkg_func, mass_min
 
     return fitter
 
+def get_fit_results(fitter, sgn_func, bin_counting_limits=None):
+    """
+    Helper method to extract the fit results as (value, error) pairs in a picklable dictionary
+    """
+    # get_fit_result is a property of F2MassFitter, not a method
+    fit_result = fitter.get_fit_result
+    results = {"converged": fit_result.converged}
+    if not results["converged"]:
+        return results
+
+    if bin_counting_limits is not None:
+        # only the raw yield is needed from the cut-variation fits, whose shape parameters
+        # are fixed to the no-cut ones and hence not among the fitted parameters
+        results["rawyield"] = fitter.get_raw_yield_bincounting(
+            0, min=bin_counting_limits[0], max=bin_counting_limits[1])
+        return results
+
+    results["rawyield"] = fitter.get_raw_yield(0)
+    results["sigma"] = fitter.get_signal_parameter(0, "sigma")
+    results["mean"] = fitter.get_mass(0)
+    if sgn_func == "doublecb":
+        for par in ["alphal", "alphar", "nl", "nr"]:
+            results[par] = fitter.get_signal_parameter(0, par)
+
+    return results
+
+
+def dump_fit_outputs(fitter, outputs):
+    """
+    Helper method to write the ROOT and PDF outputs of a fit, to be called where the fitter lives;
+    figures are closed once saved, otherwise pyplot keeps them alive in the worker
+    """
+    if outputs.get("root_file") is not None:
+        fitter.dump_to_root(outputs["root_file"], option="recreate", suffix=outputs["root_suffix"])
+    # plots are saved right away: matplotlib is not thread-safe, so they cannot be written
+    # in background threads while the next fit is plotted
+    if outputs.get("massfit") is not None:
+        fig = fitter.plot_mass_fit(style="ATLAS", figsize=(8, 8),
+                                   axis_title=outputs["axis_title"], show_extra_info = True)
+        fig[0].savefig(outputs["massfit"])
+        plt.close(fig[0])
+    if outputs.get("massfitres") is not None:
+        figres = fitter.plot_raw_residuals(figsize=(8, 8), style="ATLAS")
+        figres.savefig(outputs["massfitres"])
+        plt.close(figres)
+
+
+def init_fit_worker(n_intra_threads):
+    """
+    Method to configure TensorFlow in each worker process before running any fit
+    """
+    # the parallelism is given by the process pool, so each process runs one TensorFlow op at a
+    # time on its share of the cores to avoid oversubscribing them. The initializer runs after the
+    # spawned process has re-imported this module (and zfit); if the TensorFlow runtime was already
+    # initialised the threading cannot be changed anymore and the default is kept
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(n_intra_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except RuntimeError as err:
+        print(f"WARNING: TensorFlow threads of fit worker not configured ({err})")
+
+
+def fit_worker(job):
+    """
+    Method to perform a single fit in a worker process, only picklable results are returned
+    """
+    (file_name, histo_name, *fit_args), sgn_func, bin_counting_limits, outputs = job
+    # the histogram is taken from the file kept open by the worker, ROOT objects are not
+    # sent between processes
+    hist = get_input_file(file_name).Get(histo_name)
+    # detached from the input file so that it is freed after the fit
+    hist.SetDirectory(0)
+    ROOT.SetOwnership(hist, True)
+    fitter = perform_fit(hist, *fit_args)
+    results = get_fit_results(fitter, sgn_func, bin_counting_limits)
+    if results["converged"]:
+        dump_fit_outputs(fitter, outputs)
+    # the fitter keeps the zfit model and graphs, which are released before the next fit
+    # (the reference cycles of zfit objects are only freed by the garbage collector)
+    del fitter
+    gc.collect()
+
+    return results
+
+
+def get_hist_from_arrays(name, title, bin_limits, contents, errors):
+    """
+    Helper method to create a TH1F filled in one go from the arrays of bin contents and errors
+    """
+    hist = ROOT.TH1F(name, title, len(bin_limits) - 1, bin_limits)
+    hist.SetDirectory(0)
+    # under- and overflow bins are included in the arrays passed to ROOT
+    hist.SetContent(np.concatenate(([0.], contents, [0.])))
+    hist.SetError(np.concatenate(([0.], errors, [0.])))
+    # SetContent sets the entries to the number of cells, one entry per filled bin as with SetBinContent
+    hist.SetEntries(np.count_nonzero(contents))
+
+    return hist
+
+
+def copy_fit_outputs(infile_name, outfile):
+    """
+    Helper method to copy the objects written by a worker process to the already open output file,
+    the objects are assumed to be at the top level of the input file (no subdirectories)
+    """
+    infile = ROOT.TFile.Open(infile_name)
+    # only the highest cycle of each object is copied
+    keys = {}
+    for key in infile.GetListOfKeys():
+        if key.GetName() not in keys or key.GetCycle() > keys[key.GetName()].GetCycle():
+            keys[key.GetName()] = key
+    for name, key in keys.items():
+        obj = key.ReadObj()
+        outfile.cd()
+        obj.Write(name)
+    infile.Close()
+    os.remove(infile_name)
+
+
+def get_n_cpus():
+    """
+    Helper method to get the number of cores available to this process
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is not available on all platforms (e.g. macOS)
+        return os.cpu_count() or 1
+
+
 # function to perform fits
-def fit(input_config, fix_mean, plot_npcut):
+def fit(input_config, fix_mean, plot_nocut, plot_npcut, num_workers):
     """
     Method for fitting
     """
@@ -87,14 +269,19 @@ def fit(input_config, fix_mean, plot_npcut):
         print(f"ERROR: {cfg['hadron']} not supported, exit")
         sys.exit()
     check_config_consistency(cfg)
+    # config entries used in the loops are copied once to local variables
+    hadron = cfg["hadron"]
     outputdir = cfg["output"]["rawyields"]["directory"]
     suffix = cfg["output"]["rawyields"]["suffix"]
 
+    if hadron == "dstar":
+        mass = pdg_api.get_particle_by_mcid(413).mass - pdg_api.get_particle_by_mcid(421).mass
+    if hadron == "dplus":
+        mass = pdg_api.get_particle_by_mcid(411).mass
+
     pt_mins = cfg["pt_mins"]
     pt_maxs = cfg["pt_maxs"]
-    pt_limits = pt_mins.copy()
-    pt_limits.append(pt_maxs[-1])
-    pt_limits = np.array(pt_limits, np.float64)
+    pt_limits = np.asarray([*pt_mins, pt_maxs[-1]], dtype=np.float64)
 
     infile_name = os.path.join(outputdir, f"hist_mass{suffix}.root")
 
@@ -107,151 +294,208 @@ def fit(input_config, fix_mean, plot_npcut):
     # we first fit the high significance cases
     outfile_name_nocut = os.path.join(outputdir, f"rawyields_nocut{suffix}.root")
     outfile_nocut = ROOT.TFile(outfile_name_nocut, "recreate")
-    outfile_nocut.Close()
 
-    hist_rawyield_nocut = ROOT.TH1F(
-        "hist_rawyield", ";#it{p}_{T} (GeV/#it{c}); raw yield", len(pt_mins), pt_limits)
-    hist_sigma_nocut = ROOT.TH1F(
-        "hist_sigma", ";#it{p}_{T} (GeV/#it{c}); #sigma (GeV/#it{c}^{2})", len(pt_mins), pt_limits)
-    hist_mean_nocut = ROOT.TH1F(
-        "hist_mean", ";#it{p}_{T} (GeV/#it{c}); #mu (GeV/#it{c}^{2})", len(pt_mins), pt_limits)
-    hist_alphal_nocut = ROOT.TH1F(
-        "hist_alphal", ";#it{p}_{T} (GeV/#it{c}); #alpha_{l}", len(pt_mins), pt_limits)
-    hist_alphar_nocut = ROOT.TH1F(
-        "hist_alphar", ";#it{p}_{T} (GeV/#it{c}); #alpha_{r}", len(pt_mins), pt_limits)
-    hist_nl_nocut = ROOT.TH1F(
-        "hist_nl", ";#it{p}_{T} (GeV/#it{c}); #it{n}_{l}", len(pt_mins), pt_limits)
-    hist_nr_nocut = ROOT.TH1F(
-        "hist_nr", ";#it{p}_{T} (GeV/#it{c}); #it{n}_{r}", len(pt_mins), pt_limits)
-
-    hist_rawyield_nocut.SetDirectory(0)
-    hist_sigma_nocut.SetDirectory(0)
-    hist_mean_nocut.SetDirectory(0)
-    hist_alphal_nocut.SetDirectory(0)
-    hist_alphar_nocut.SetDirectory(0)
-    hist_nl_nocut.SetDirectory(0)
-    hist_nr_nocut.SetDirectory(0)
-
-    hist_rawyield_cutvar = []
-    for icut, _ in enumerate(bdt_np_mins):
-        hist_rawyield_cutvar.append(
-            ROOT.TH1F("hist_rawyield", ";#it{p}_{T} (GeV/#it{c}); raw yield", len(pt_mins), pt_limits))
-        hist_rawyield_cutvar[icut].SetDirectory(0)
-
-    fitter = []
-    for ipt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
-        if cfg["hadron"] == "dstar":
-            mass = pdg_api.get_particle_by_mcid(413).mass - pdg_api.get_particle_by_mcid(421).mass
-        if cfg["hadron"] == "dplus":
-            mass = pdg_api.get_particle_by_mcid(411).mass
-        fitter.append(
-            perform_fit(infile_name,
-                        f"hist_mass_pt{pt_min:.1f}_{pt_max:.1f}_nocutnp",
-                        f"{cfg['hadron']}_pt{pt_min:.1f}_{pt_max:.1f}_nocutnp",
+    values_nocut = {par: np.zeros(len(pt_mins)) for par in NOCUT_HISTO_TITLES}
+    errors_nocut = {par: np.zeros(len(pt_mins)) for par in NOCUT_HISTO_TITLES}
+
+    rawyields_cutvar = np.zeros((len(bdt_np_mins), len(pt_mins)))
+    rawyield_errs_cutvar = np.zeros_like(rawyields_cutvar)
+
+    xaxis = ""
+    if hadron == "dstar":
+        xaxis = r"$M(\mathrm{K}\pi\pi) - M(\mathrm{K}\pi)$ (GeV/$c^{2}$)"
+    elif hadron == "dplus":
+        xaxis = r"$M(\mathrm{K}\pi\pi)$ (GeV/$c^{2}$)"
+    bin_counting_limits = [0.14, 0.16] if hadron == "dstar" else [1.70, 2.00]
+
+    # the fits are independent, so they are distributed over several processes (the spawn
+    # start method is used since neither ROOT nor TensorFlow are fork-safe)
+    n_cpus = get_n_cpus()
+    num_workers = max(1, min(num_workers or n_cpus, n_cpus))
+    if tf.config.list_physical_devices("GPU"):
+        # every worker would create its own CUDA context on the same device
+        print("INFO: GPU found, the fits are performed with a single worker")
+        num_workers = 1
+    jobs_nocut = []
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_fit_worker,
+                                 initargs=(max(1, n_cpus // num_workers),)) as pool:
+            for ipt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
+                jobs_nocut.append((
+                    (infile_name,
+                     f"hist_mass_pt{pt_min:.1f}_{pt_max:.1f}_nocutnp",
+                     f"{hadron}_pt{pt_min:.1f}_{pt_max:.1f}_nocutnp",
+                     sgn_funcs[ipt],
+                     bkg_funcs[ipt],
+                     mass_mins[ipt],
+                     mass_maxs[ipt],
+                     mass,
+                     hadron),
+                    sgn_funcs[ipt],
+                    None,
+                    {"root_file": os.path.join(outputdir, f"rawyields_nocut{suffix}_pt{pt_min:.1f}_{pt_max:.1f}.root"),
+                     "root_suffix": f"_pt{pt_min:.1f}_{pt_max:.1f}_nocutnp",
+                     "axis_title": xaxis,
+                     "massfit": os.path.join(
+                         outputdir, f"massfit{suffix}_pt{pt_min:.1f}_{pt_max:.1f}_nocutnp.pdf"
+                     ) if plot_nocut else None,
+                     "massfitres": os.path.join(
+                         outputdir, f"massfitres{suffix}_pt{pt_min:.1f}_{pt_max:.1f}_nocutnp.pdf"
+                     ) if plot_nocut else None}
+                ))
+            results_nocut = list(pool.map(fit_worker, jobs_nocut))
+
+            jobs_cutvar = []
+            for ipt, ((pt_min, pt_max), results) in enumerate(zip(zip(pt_mins, pt_maxs), results_nocut)):
+                pars_tofix = {}
+                if results["converged"]:
+                    pars_tofix["sigma"] = results["sigma"][0]
+                    if fix_mean:
+                        pars_tofix["mean"] = results["mean"][0]
+                    if sgn_funcs[ipt] == "doublecb":
+                        pars_tofix["alphal"] = results["alphal"][0]
+                        pars_tofix["alphar"] = results["alphar"][0]
+                        pars_tofix["nl"] = results["nl"][0]
+                        pars_tofix["nr"] = results["nr"][0]
+                    for par in NOCUT_HISTO_TITLES:
+                        if par in results:
+                            values_nocut[par][ipt], errors_nocut[par][ipt] = results[par]
+
+                    copy_fit_outputs(jobs_nocut[ipt][3]["root_file"], outfile_nocut)
+
+                for bdt_np_min in bdt_np_mins:
+                    jobs_cutvar.append((
+                        (infile_name,
+                         f"hist_mass_pt{pt_min:.1f}_{pt_max:.1f}_bdtnp{bdt_np_min:.2f}",
+                         f"{hadron}_pt{pt_min:.1f}_{pt_max:.1f}_bdtnp{bdt_np_min:.2f}",
+                         sgn_funcs[ipt],
+                         bkg_funcs[ipt],
+                         mass_mins[ipt],
+                         mass_maxs[ipt],
+                         mass,
+                         hadron,
+                         pars_tofix),
                         sgn_funcs[ipt],
-                        bkg_funcs[ipt],
-                        mass_mins[ipt],
-                        mass_maxs[ipt],
-                        mass,
-                        cfg["hadron"])
-        )
-
-        pars_tofix = {}
-        if fitter[ipt].get_fit_result.converged:
-            rawyield = fitter[ipt].get_raw_yield(0)
-            sigma = fitter[ipt].get_signal_parameter(0, "sigma")
-            mean = fitter[ipt].get_mass(0)
-            pars_tofix["sigma"] = sigma[0]
-            if fix_mean:
-                pars_tofix["mean"] = mean[0]
-            hist_rawyield_nocut.SetBinContent(ipt+1, rawyield[0])
-            hist_rawyield_nocut.SetBinError(ipt+1, rawyield[1])
-            hist_sigma_nocut.SetBinContent(ipt+1, sigma[0])
-            hist_sigma_nocut.SetBinError(ipt+1, sigma[1])
-            hist_mean_nocut.SetBinContent(ipt+1, mean[0])
-            hist_mean_nocut.SetBinError(ipt+1, mean[1])
-            if sgn_funcs[ipt] == "doublecb":
-                alphal = fitter[ipt].get_signal_parameter(0, "alphal")
-                alphar = fitter[ipt].get_signal_parameter(0, "alphar")
-                nl = fitter[ipt].get_signal_parameter(0, "nl")
-                nr = fitter[ipt].get_signal_parameter(0, "nr")
-                pars_tofix["alphal"] = alphal[0]
-                pars_tofix["alphar"] = alphar[0]
-                pars_tofix["nl"] = nl[0]
-                pars_tofix["nr"] = nr[0]
-                hist_alphal_nocut.SetBinContent(ipt+1, alphal[0])
-                hist_alphal_nocut.SetBinError(ipt+1, alphal[1])
-                hist_alphar_nocut.SetBinContent(ipt+1, alphar[0])
-                hist_alphar_nocut.SetBinError(ipt+1, alphar[1])
-                hist_nl_nocut.SetBinContent(ipt+1, nl[0])
-                hist_nl_nocut.SetBinError(ipt+1, nl[1])
-                hist_nr_nocut.SetBinContent(ipt+1, nr[0])
-                hist_nr_nocut.SetBinError(ipt+1, nr[1])                
-
-            fitter[ipt].dump_to_root(outfile_name_nocut,
-                                     option="update",
-                                     suffix=f"_pt{pt_min:.1f}_{pt_max:.1f}_nocutnp")
-            xaxis = ""
-            if cfg["hadron"] == "dstar":
-                xaxis = r"$M(\mathrm{K}\pi\pi) - M(\mathrm{K}\pi)$ (GeV/$c^{2}$)"
-            elif cfg["hadron"] == "dplus":
-                xaxis = r"$M(\mathrm{K}\pi\pi)$ (GeV/$c^{2}$)"
-            fig = fitter[ipt].plot_mass_fit(style="ATLAS", figsize=(8, 8), axis_title=xaxis, show_extra_info = True)
-            figres = fitter[ipt].plot_raw_residuals(figsize=(8, 8), style="ATLAS")
-
-            fig.savefig(
-                os.path.join(outputdir, f"massfit{suffix}_pt{pt_min:.1f}_{pt_max:.1f}_nocutnp.pdf")
-            )
-            figres.savefig(
-                os.path.join(outputdir, f"massfitres{suffix}_pt{pt_min:.1f}_{pt_max:.1f}_nocutnp.pdf")
-            )
-
-        fitter_pt_cutvar = []
-        for icut, bdt_np_min in enumerate(bdt_np_mins):
-            fitter_pt_cutvar.append(
-                perform_fit(infile_name,
-                            f"hist_mass_pt{pt_min:.1f}_{pt_max:.1f}_bdtnp{bdt_np_min:.2f}",
-                            f"{cfg['hadron']}_pt{pt_min:.1f}_{pt_max:.1f}_bdtnp{bdt_np_min:.2f}",
-                            sgn_funcs[ipt],
-                            bkg_funcs[ipt],
-                            mass_mins[ipt],
-                            mass_maxs[ipt],
-                            mass,
-                            cfg["hadron"],
-                            pars_tofix)
-            )
-            if fitter_pt_cutvar[icut].get_fit_result.converged:
-                bin_counting_min = 0.14 if cfg["hadron"] == "dstar" else 1.70
-                bin_counting_max = 0.16 if cfg["hadron"] == "dstar" else 2.00
-                rawyield = fitter_pt_cutvar[icut].get_raw_yield_bincounting(
-                    0, min=bin_counting_min, max=bin_counting_max)
-                hist_rawyield_cutvar[icut].SetBinContent(ipt+1, rawyield[0])
-                hist_rawyield_cutvar[icut].SetBinError(ipt+1, rawyield[1])
-                if plot_npcut:
-                    fig = fitter_pt_cutvar[icut].plot_mass_fit(style="ATLAS", figsize=(8, 8), axis_title=r"Inv Mass (GeV/c^2)", show_extra_info = True)
-                    fig[0].savefig(
-                        os.path.join(outputdir, "plots_npcut", f"massfit{suffix}_pt{pt_min:.1f}_{pt_max:.1f}_cutnp_{bdt_np_mins[icut]}.pdf")
-                    )
-                    
+                        bin_counting_limits,
+                        {"axis_title": r"Inv Mass (GeV/c^2)",
+                         "massfit": os.path.join(
+                             outputdir, "plots_npcut",
+                             f"massfit{suffix}_pt{pt_min:.1f}_{pt_max:.1f}_cutnp_{bdt_np_min}.pdf"
+                         ) if plot_npcut else None}
+                    ))
+            results_cutvar = list(pool.map(fit_worker, jobs_cutvar))
+    finally:
+        # per-bin files of the workers are left behind if a fit failed
+        for job in jobs_nocut:
+            if os.path.exists(job[3]["root_file"]):
+                os.remove(job[3]["root_file"])
+
+    for ijob, results in enumerate(results_cutvar):
+        ipt, icut = divmod(ijob, len(bdt_np_mins))
+        if results["converged"]:
+            rawyields_cutvar[icut, ipt], rawyield_errs_cutvar[icut, ipt] = results["rawyield"]
 
     for icut, bdt_np_min in enumerate(bdt_np_mins):
         outfile_name_cutvar = os.path.join(
             outputdir, f"rawyields_bdtnp{bdt_np_min:0.2f}{suffix}.root")
         outfile_cutvar = ROOT.TFile(outfile_name_cutvar, "recreate")
-        hist_rawyield_cutvar[icut].Write()
+        hist_rawyield_cutvar = get_hist_from_arrays(
+            "hist_rawyield", ";#it{p}_{T} (GeV/#it{c}); raw yield",
+            pt_limits, rawyields_cutvar[icut], rawyield_errs_cutvar[icut])
+        hist_rawyield_cutvar.Write()
         outfile_cutvar.Close()
 
-    outfile_nocut = ROOT.TFile(outfile_name_nocut, "update")
-    hist_rawyield_nocut.Write()
-    hist_sigma_nocut.Write()
-    hist_mean_nocut.Write()
-    hist_alphal_nocut.Write()
-    hist_alphar_nocut.Write()
-    hist_nl_nocut.Write()
-    hist_nr_nocut.Write()
+    outfile_nocut.cd()
+    for par, title in NOCUT_HISTO_TITLES.items():
+        hist = get_hist_from_arrays(f"hist_{par}", f";#it{{p}}_{{T}} (GeV/#it{{c}}); {title}",
+                                    pt_limits, values_nocut[par], errors_nocut[par])
+        hist.Write()
     outfile_nocut.Close()
 
 
+def get_sparse_cells(sparse):
+    """
+    Helper method to copy the coordinates, contents and squared errors of the filled cells
+    of a THnSparse in numpy arrays with a single loop over the sparse
+    """
+    n_cells = sparse.GetNbins()
+    coords = np.zeros((n_cells, sparse.GetNdimensions()), dtype=np.int32)
+    weights = np.zeros(n_cells)
+    weights2 = np.zeros(n_cells)
+    calculate_errors = sparse.GetCalculateErrors()
+    for icell in range(n_cells):
+        weights[icell] = sparse.GetBinContent(icell, coords[icell])
+        weights2[icell] = sparse.GetBinError2(icell) if calculate_errors else weights[icell]
+
+    return coords, weights, weights2
+
+
+def get_axis_edges(axis):
+    """
+    Helper method to get the bin edges of a TAxis as a numpy array
+    """
+    return np.array([axis.GetBinLowEdge(ibin) for ibin in range(1, axis.GetNbins() + 2)])
+
+
+def find_bins(edges, values):
+    """
+    Helper method equivalent to TAxis::FindBin for an array of values (0 is the underflow
+    bin, len(edges) the overflow one)
+    """
+    return np.searchsorted(edges, values, side="right").astype(np.int32)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def accumulate_mass_counts(coords, weights, weights2, pt_bin_mins, pt_bin_maxs, bkg_bin_maxs, np_bin_mins,
+                           n_mass_cells):
+    """
+    Helper method to fill the mass projections of all the pT bins and BDT cuts from the
+    filled cells of the sparse, the first cut index corresponds to no cut on the BDT non-prompt score;
+    the sums of the squared weights are accumulated as well for the errors
+    """
+    n_pt = len(pt_bin_mins)
+    n_cuts = len(np_bin_mins)
+    counts = np.zeros((n_pt, n_cuts + 1, n_mass_cells))
+    sumw2 = np.zeros((n_pt, n_cuts + 1, n_mass_cells))
+    # each pT bin writes only its own slice, so the threads never update the same cell
+    for ipt in prange(n_pt):
+        for icell in range(len(weights)):
+            if coords[icell, 1] < pt_bin_mins[ipt] or coords[icell, 1] > pt_bin_maxs[ipt]:
+                continue
+            if coords[icell, 2] < 1 or coords[icell, 2] > bkg_bin_maxs[ipt]:
+                continue
+            counts[ipt, 0, coords[icell, 0]] += weights[icell]
+            sumw2[ipt, 0, coords[icell, 0]] += weights2[icell]
+            for icut in range(n_cuts):
+                if coords[icell, 3] >= np_bin_mins[icut]:
+                    counts[ipt, icut + 1, coords[icell, 0]] += weights[icell]
+                    sumw2[ipt, icut + 1, coords[icell, 0]] += weights2[icell]
+
+    return counts, sumw2
+
+
+def get_mass_projection(name, sparse, mass_edges, counts, sumw2):
+    """
+    Helper method to build the projection on the mass axis from the accumulated counts,
+    it replaces THnSparse::Projection(0)
+    """
+    hist = ROOT.TH1D(name, f"{sparse.GetTitle()} projection", len(mass_edges) - 1, mass_edges)
+    hist.GetXaxis().SetTitle(sparse.GetAxis(0).GetTitle())
+    # the counts include under- and overflow bins as the TH1 array
+    hist.SetContent(np.ascontiguousarray(counts))
+    # errors propagated as in the projection of a sparse with Sumw2
+    if sparse.GetCalculateErrors():
+        hist.Sumw2()
+        hist.SetError(np.sqrt(sumw2))
+    # statistics recomputed from the bin contents as in THnSparse::Projection
+    hist.ResetStats()
+    hist.SetEntries(hist.GetEffectiveEntries())
+
+    return hist
+
+
 # function to project the sparse
 def project(input_config):
     """
@@ -280,29 +524,36 @@ def project(input_config):
     if not isinstance(bdt_bkg_cuts, list):
         bdt_bkg_cuts = [bdt_bkg_cuts]*len(pt_mins)
 
-    outfile = ROOT.TFile(os.path.join(outputdir, f"hist_mass{suffix}.root"), "recreate")
+    # the sparse is traversed only once, the projections are then obtained from the filled cells
+    coords, weights, weights2 = get_sparse_cells(sparse)
+    # bin edges fetched once, the bins of the cuts are then found with numpy as TAxis::FindBin
+    mass_edges = get_axis_edges(sparse.GetAxis(0))
+    pt_edges = get_axis_edges(sparse.GetAxis(1))
+    bkg_edges = get_axis_edges(sparse.GetAxis(2))
+    np_edges = get_axis_edges(sparse.GetAxis(3))
+
+    bdt_np_mins = cfg["bdt_cuts"]["nonprompt"]
+    pt_bin_mins = find_bins(pt_edges, np.array(pt_mins) * 1.001)
+    pt_bin_maxs = find_bins(pt_edges, np.array(pt_maxs) * 0.999)
+    bkg_bin_maxs = find_bins(bkg_edges, np.array(bdt_bkg_cuts) * 0.999)
+    np_bin_mins = find_bins(np_edges, np.array(bdt_np_mins) * 1.001)
+    counts, sumw2 = accumulate_mass_counts(coords, weights, weights2, pt_bin_mins, pt_bin_maxs,
+                                           bkg_bin_maxs, np_bin_mins, len(mass_edges) + 1)
+
+    # intermediate file read back by the fits, no need to compress it
+    outfile = ROOT.TFile.Open(os.path.join(outputdir, f"hist_mass{suffix}.root"), "recreate", "", 0)
 
-    histos_pt, histos_pt_cutvar = [], []
     for ipt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
         print(f'projecting in pt range {pt_min, pt_max}')
-        bdt_bkg_bin_max = sparse.GetAxis(2).FindBin(bdt_bkg_cuts[ipt]*0.999)
-        sparse.GetAxis(2).SetRange(1, bdt_bkg_bin_max)
-        pt_bin_min = sparse.GetAxis(1).FindBin(pt_min*1.001)
-        pt_bin_max = sparse.GetAxis(1).FindBin(pt_max*0.999)
-        sparse.GetAxis(1).SetRange(pt_bin_min, pt_bin_max)
-        histos_pt.append(sparse.Projection(0))
-        histos_pt[ipt].SetName(f"hist_mass_pt{pt_min:.1f}_{pt_max:.1f}_nocutnp")
         outfile.cd()
-        histos_pt[ipt].Write()
-        histos_pt_cutvar.append([])
-        for bdt_np_min in cfg["bdt_cuts"]["nonprompt"]:
-            bdt_bkg_np_min = sparse.GetAxis(3).FindBin(bdt_np_min*1.001)
-            sparse.GetAxis(3).SetRange(bdt_bkg_np_min, sparse.GetAxis(3).GetNbins()+1)
-            histos_pt_cutvar[ipt].append(sparse.Projection(0))
-            histos_pt_cutvar[ipt][-1].SetName(f"hist_mass_pt{pt_min:.1f}_{pt_max:.1f}_bdtnp{bdt_np_min:.2f}")
+        hist = get_mass_projection(f"hist_mass_pt{pt_min:.1f}_{pt_max:.1f}_nocutnp",
+                                   sparse, mass_edges, counts[ipt, 0], sumw2[ipt, 0])
+        hist.Write()
+        for icut, bdt_np_min in enumerate(bdt_np_mins):
             outfile.cd()
-            histos_pt_cutvar[ipt][-1].Write()
-            sparse.GetAxis(3).SetRange(-1, -1)
+            hist = get_mass_projection(f"hist_mass_pt{pt_min:.1f}_{pt_max:.1f}_bdtnp{bdt_np_min:.2f}",
+                                       sparse, mass_edges, counts[ipt, icut + 1], sumw2[ipt, icut + 1])
+            hist.Write()
     outfile.Close()
 
 
@@ -316,12 +567,16 @@ if __name__ == "__main__":
                         default=False, help="enable fit w/o cut")
     parser.add_argument("--fix_mean", "-fm", action="store_true",
                         default=False, help="fix gaussian mean in fit")
+    parser.add_argument("--plot_nocut", "-pn", action="store_true",
+                        default=False, help="save plots of fits w/o cut")
     parser.add_argument("--plot_npcut", "-pl", action="store_true",
-                        default=False, help="save all plots")
+                        default=False, help="save plots of fits with non-prompt BDT cuts")
+    parser.add_argument("--jobs", "-j", type=int, default=get_n_cpus(),
+                        help="number of workers for the fits")
     args = parser.parse_args()
 
     if args.project:
         project(args.cfg_file)
 
     if args.fit:
-        fit(args.cfg_file, args.fix_mean, args.plot_npcut)
+        fit(args.cfg_file, args.fix_mean, args.plot_nocut, args.plot_npcut, args.jobs)